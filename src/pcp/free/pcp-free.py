@@ -17,11 +17,20 @@
 """ Display amount of free and used memory in the system """
 
 import sys
+import itertools
 from pcp import pmapi
 from cpmapi import PM_TYPE_U64, PM_CONTEXT_ARCHIVE, PM_SPACE_KBYTE
 
-if sys.version >= '3':
-    long = int  # python2 to python3 portability (no long() in python3)
+def scaler(shift):
+    """ Return a function converting a value in kilobytes into display
+        units, given the bitshift between bytes and those units.
+    """
+    delta = shift - 10
+    if delta == 0:      # kilobytes, the default - values already in KB
+        return lambda value: value
+    if delta > 0:
+        return lambda value: value >> delta
+    return lambda value: value << -delta
 
 class Free(object):
     """ Gives a short summary of kernel virtual memory information,
@@ -32,6 +41,21 @@ class Free(object):
         the metric source, at an offset within an archive, and so on.
     """
 
+    __slots__ = ('count', 'pause', 'shift', 'show_wide', 'show_high',
+                 'show_total', 'show_compat', 'opts', 'interval', 'context',
+                 '_metrics', '_index', '_kb_units', '_desc_types', '_values',
+                 '_report_fmt', '_report_args')
+
+    # output templates, joined and applied to one flat tuple per sample
+    _FMT_WIDE = "%-7s %11d %11d %11d %11d %11d %11d %11d"
+    _FMT_NARROW = "%-7s %11d %11d %11d %11d %11d %11d"
+    _FMT_HIGH = "\n".join([
+        "%-7s %11d %11d %11d",
+        "%-7s %11d %11d %11d"])
+    _FMT_COMPAT = "%s:  %11d %11d"
+    _FMT_SWAP = "%-7s %11d %11d %11d"
+    _FMT_TOTAL = "%-7s %11d %11d %11d"
+
     def __init__(self):
         """ Construct object - prepare for command line handling """
         self.count = 0       # number of samples to report
@@ -44,6 +68,13 @@ class Free(object):
         self.opts = self.options()
         self.interval = pmapi.timeval()
         self.context = None
+        self._metrics = None     # names of the metrics to be fetched
+        self._index = None       # metric name to values list offset
+        self._kb_units = None    # pmUnits target for pmConvScale
+        self._desc_types = None  # metric types, from pmLookupDescs
+        self._values = None      # sample buffer, reused across fetches
+        self._report_fmt = None  # output format for one complete sample
+        self._report_args = None # values list to format arguments function
 
     def options(self):
         """ Setup default command line argument option handling """
@@ -111,126 +142,200 @@ class Free(object):
             self.opts.pmSetOptionSamples(optarg)
             self.count = self.opts.pmGetOptionSamples()
 
-    def scale(self, value):
-        """ Convert a given value in kilobytes into display units """
-        return long(value << 10) >> self.shift
-
-    def extract(self, descs, result):
-        """ Extract the set of metric values from a given pmResult """
-        values = []
-        for index, desc in enumerate(descs):
-            if result.contents.get_numval(index) > 0:
-                atom = self.context.pmExtractValue(
-                                result.contents.get_valfmt(index),
-                                result.contents.get_vlist(index, 0),
-                                desc.contents.type, PM_TYPE_U64)
-                atom = self.context.pmConvScale(PM_TYPE_U64, atom, descs, index,
-                                pmapi.pmUnits(1, 0, 0, PM_SPACE_KBYTE, 0, 0))
-                values.append(long(atom.ull))
+    def extract(self, descs, result, _PM_TYPE_U64=PM_TYPE_U64):
+        """ Extract metric values from a given pmResult into self._values """
+        # pylint: disable=C0103
+        rc = result.contents
+        ctx = self.context
+        extract_v = ctx.pmExtractValue
+        conv = ctx.pmConvScale
+        get_nv = rc.get_numval
+        get_vf = rc.get_valfmt
+        get_vl = rc.get_vlist
+        types = self._desc_types
+        units = self._kb_units
+        values = self._values
+        for index, dtype in enumerate(types):
+            if get_nv(index) > 0:
+                atom = extract_v(get_vf(index), get_vl(index, 0),
+                                 dtype, _PM_TYPE_U64)
+                atom = conv(_PM_TYPE_U64, atom, descs, index, units)
+                values[index] = atom.ull
             else:
-                values.append(long(0))
-        return values
+                values[index] = 0
 
     def execute(self):
         """ Using a PMAPI context (could be either host or archive),
-            fetch and report a fixed set of values related to memory.
+            fetch and report a set of values related to memory.
         """
-        metrics = ('mem.physmem',
-                   'mem.util.free',  'mem.util.shmem',
-                   'mem.util.bufmem',  'mem.util.cached',
-                   'mem.util.highFree',  'mem.util.highTotal',
-                   'mem.util.lowFree',  'mem.util.lowTotal',
-                   'mem.util.swapFree',  'mem.util.swapTotal',
-                   'mem.util.available',  'mem.util.slabReclaimable')
-
+        metrics = self._metrics
         pmids = self.context.pmLookupName(metrics)
         descs = self.context.pmLookupDescs(pmids)
 
-        if self.pause is None and self.count == 0:
-            self.count = 1
+        # invariant across samples - setup once, not on every fetch
+        self._kb_units = pmapi.pmUnits(1, 0, 0, PM_SPACE_KBYTE, 0, 0)
+        self._desc_types = [desc.contents.type for desc in descs]
+        self._values = [0] * len(metrics)
+
+        # sample forever with an interval but no count, else count times
         if self.pause is not None and self.count == 0:
-            self.count = -1
+            samples = itertools.count()
+        else:
+            samples = range(max(self.count, 1))
+        last = self.count - 1
+        sleep = self.pause is not None and self.context.type != PM_CONTEXT_ARCHIVE
 
-        while self.count != 0:
+        # column headings are reported once only, ahead of the first sample
+        if self.show_wide:
+            columns = ('total', 'used', 'free', 'shared', 'buffers', 'cache', 'available')
+            headings = "%19s %11s %11s %11s %11s %11s %11s\n" % columns
+        else:
+            columns = ('total', 'used', 'free', 'shared', 'buff/cache', 'available')
+            headings = "%19s %11s %11s %11s %11s %11s\n" % columns
+
+        for sample in samples:
             result = self.context.pmFetch(pmids)
-            values = self.extract(descs, result)
-            self.context.pmFreeResult(result)
-            self.report(values)
-            if self.pause is not None:
-                print('') # empty line
+            try:
+                self.extract(descs, result)
+            finally:
+                self.context.pmFreeResult(result)
+            if headings is not None:    # first fetch succeeded
+                sys.stdout.write(headings)
+                headings = None
+            self.report(self._values)
+            if sleep and sample != last:
                 sys.stdout.flush()
-                if self.count > 0:
-                    self.count -= 1
-                if self.count == 0:
-                    break
-                if self.context.type != PM_CONTEXT_ARCHIVE:
-                    self.context.pmtimevalSleep(self.interval)
-            elif self.count == 1 and self.pause is None:
-                break
-            elif self.count > 0:
-                self.count -= 1
+                self.context.pmtimevalSleep(self.interval)
+        sys.stdout.flush()
 
     def report(self, values):
         """ Given the set of metric values report them in free(1) form """
-        physmem = values[0]
-        free = values[1]
-        shared = values[2]
-        buffers = values[3]
-        cached = values[4]
-        highfree = values[5]
-        hightotal = values[6]
-        lowfree = values[7]
-        lowtotal = values[8]
-        swapfree = values[9]
-        swaptotal = values[10]
-        available = values[11]
-        slabreclaim = values[12]
-
-        used = physmem - free - buffers - cached - slabreclaim
-        cache = cached + slabreclaim
-        swapused = swaptotal - swapfree
-
-        # low == main memory, except with large-memory support
-        if lowtotal == 0:
-            lowtotal = physmem
-            lowfree = free
+        sys.stdout.write(self._report_fmt % self._report_args(values))
 
-        if self.show_wide:
-            columns = ('total', 'used', 'free', 'shared', 'buffers', 'cache', 'available')
-            print("%19s %11s %11s %11s %11s %11s %11s" % columns)
-            print("%-7s %11Lu %11Lu %11Lu %11Lu %11Lu %11Lu %11Lu" % ('Mem:',
-                self.scale(physmem), self.scale(used), self.scale(free),
-                self.scale(shared), self.scale(buffers), self.scale(cache),
-                self.scale(available)))
-        else:
-            columns = ('total', 'used', 'free', 'shared', 'buff/cache', 'available')
-            print("%19s %11s %11s %11s %11s %11s" % columns)
-            print("%-7s %11Lu %11Lu %11Lu %11Lu %11Lu %11Lu" % ('Mem:',
-                self.scale(physmem), self.scale(used), self.scale(free),
-                self.scale(shared), self.scale(buffers + cache),
-                self.scale(available)))
+    def _select_metrics(self):
+        """ Choose the metrics needed for the requested output options """
+        metrics = ['mem.physmem',
+                   'mem.util.free',  'mem.util.shmem',
+                   'mem.util.bufmem',  'mem.util.cached',
+                   'mem.util.swapFree',  'mem.util.swapTotal',
+                   'mem.util.available',  'mem.util.slabReclaimable']
+        # only fetch the low and high memory metrics when reporting them
+        if self.show_high:
+            metrics += ['mem.util.highFree',  'mem.util.highTotal',
+                        'mem.util.lowFree',  'mem.util.lowTotal']
+        self._metrics = metrics
+        self._index = dict((name, i) for i, name in enumerate(metrics))
 
+    def _build_report_fmt(self):
+        """ Compose the report format string and the function producing
+            its (scaled) argument tuple from the requested output options,
+            which do not change once the command line has been processed.
+        """
+        fmt = [self._FMT_WIDE if self.show_wide else self._FMT_NARROW]
         if self.show_high:
-            print("%-7s %11Lu %11Lu %11Lu" % ('Low:', self.scale(lowtotal),
-                    self.scale(lowtotal - lowfree), self.scale(lowtotal)))
-            print("%-7s %11Lu %11Lu %11Lu" % ('High:', self.scale(hightotal),
-                    self.scale(hightotal - highfree), self.scale(highfree)))
+            fmt.append(self._FMT_HIGH)
         if self.show_compat != 0:
-            cache = buffers + cached
-            print("%s:  %11Lu %11Lu" % ('-/+ buffers/cache',
-                    self.scale(used - cache), self.scale(free + cache)))
+            fmt.append(self._FMT_COMPAT)
+        fmt.append(self._FMT_SWAP)
+        if self.show_total == 1:
+            fmt.append(self._FMT_TOTAL)
+        # with headings reported once only, separate each of many samples
+        if self.pause is not None or self.count > 1:
+            fmt.append("") # empty line
+        self._report_fmt = "\n".join(fmt) + "\n"
 
-        print("%-7s %11Lu %11Lu %11Lu" % ('Swap', self.scale(swaptotal),
-                self.scale(swapused), self.scale(swapfree)))
+        scale = scaler(self.shift)
+        show_wide = self.show_wide
+        show_high = self.show_high
+        show_compat = self.show_compat != 0
+        show_total = self.show_total == 1
 
-        if self.show_total == 1:
-            print("%-7s %11Lu %11Lu %11Lu" % ('Total',
-                    self.scale(physmem + swaptotal),
-                    self.scale(used + swapused), self.scale(free + swapfree)))
+        # resolve each metric offset into the values list once only
+        index = self._index
+        i_phys = index['mem.physmem']
+        i_free = index['mem.util.free']
+        i_shared = index['mem.util.shmem']
+        i_buffers = index['mem.util.bufmem']
+        i_cached = index['mem.util.cached']
+        i_swapfree = index['mem.util.swapFree']
+        i_swaptotal = index['mem.util.swapTotal']
+        i_avail = index['mem.util.available']
+        i_slab = index['mem.util.slabReclaimable']
+        # (low and high memory metrics are only fetched with show_high)
+        i_highfree = index.get('mem.util.highFree')
+        i_hightotal = index.get('mem.util.highTotal')
+        i_lowfree = index.get('mem.util.lowFree')
+        i_lowtotal = index.get('mem.util.lowTotal')
+
+        def report_args(values):
+            """ Scale each displayed quantity exactly once per sample """
+            physmem = values[i_phys]
+            free = values[i_free]
+            shared = values[i_shared]
+            buffers = values[i_buffers]
+            cached = values[i_cached]
+            swapfree = values[i_swapfree]
+            swaptotal = values[i_swaptotal]
+            available = values[i_avail]
+            slabreclaim = values[i_slab]
+
+            used = physmem - free - buffers - cached - slabreclaim
+            cache = cached + slabreclaim
+            swapused = swaptotal - swapfree
+
+            s_phys = scale(physmem)
+            s_used = scale(used)
+            s_free = scale(free)
+            s_shared = scale(shared)
+            s_avail = scale(available)
+
+            if show_wide:
+                args = ('Mem:', s_phys, s_used, s_free, s_shared,
+                        scale(buffers), scale(cache), s_avail)
+            else:
+                buffcache = buffers + cache
+                args = ('Mem:', s_phys, s_used, s_free, s_shared,
+                        scale(buffcache), s_avail)
+
+            if show_high:
+                highfree = values[i_highfree]
+                hightotal = values[i_hightotal]
+                lowfree = values[i_lowfree]
+                lowtotal = values[i_lowtotal]
+                # low == main memory, except with large-memory support
+                if lowtotal == 0:
+                    lowtotal = physmem
+                    lowfree = free
+                lowused = lowtotal - lowfree
+                highused = hightotal - highfree
+                s_lowtotal = scale(lowtotal)
+                args += ('Low:', s_lowtotal, scale(lowused), s_lowtotal,
+                         'High:', scale(hightotal), scale(highused),
+                         scale(highfree))
+            if show_compat:
+                compat_cache = buffers + cached
+                compat_used = used - compat_cache
+                compat_free = free + compat_cache
+                args += ('-/+ buffers/cache',
+                         scale(compat_used), scale(compat_free))
+
+            args += ('Swap', scale(swaptotal), scale(swapused), scale(swapfree))
+
+            if show_total:
+                tot_phys = physmem + swaptotal
+                tot_used = used + swapused
+                tot_free = free + swapfree
+                args += ('Total', scale(tot_phys),
+                         scale(tot_used), scale(tot_free))
+            return args
+
+        self._report_args = report_args
 
     def connect(self):
         """ Establish a PMAPI context to archive, host or local, via args """
         self.context = pmapi.pmContext.fromOptions(self.opts, sys.argv)
+        self._select_metrics()
+        self._build_report_fmt()
 
 if __name__ == '__main__':
     try: